@@ -0,0 +1,391 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+from collections import Counter
+import logging
+import os
+import sys
+import threading
+import time
+
+# cProfile, pstats, hmac and random are only needed once a request is
+# sampled or asks for profiling, so they're imported where used to keep
+# startup cheap while profiling is off
+
+# Settings, read per request from the WSGI environ (eg. Apache's SetEnv)
+PROFILE_RATE = "TFL_PROFILE_RATE"
+PROFILE_TOKEN = "TFL_PROFILE_TOKEN"
+PROFILE_DIR = "TFL_PROFILE_DIR"
+PROFILE_INTERVAL = "TFL_PROFILE_INTERVAL"
+PROFILE_MODE = "TFL_PROFILE_MODE"
+
+# Profiling modes, deterministic with cProfile or wall-clock sampled stacks
+MODE_PSTATS = "pstats"
+MODE_STACKS = "stacks"
+
+# Admin-only headers, only honoured when they carry the profile token
+PROFILE_HEADER = "HTTP_X_TFL_PROFILE"
+PROFILE_DUMP_HEADER = "HTTP_X_TFL_PROFILE_DUMP"
+
+DEFAULT_DIR = "profile"
+PSTATS_EXTENSION = ".pstats"
+COLLAPSED_EXTENSION = ".collapsed"
+DEFAULT_INTERVAL = 0.005
+# Caps the distinct stacks kept per query, the rest are counted as truncated
+MAX_STACKS = 5000
+TRUNCATED_STACK = "[truncated]"
+
+
+def _getfloat(environ, key, default):
+    try:
+        return float(environ.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _write_atomic(filename, write):
+    """Call write with a temporary filename, then rename it into place so
+    readers never see a partly written file"""
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except (IOError, OSError) as e:
+        pass
+
+    tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        write(tmp_filename)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def _write_collapsed(stacks):
+    def write(filename):
+        with open(filename, 'w') as cf:
+            for stack, count in sorted(stacks.items()):
+                cf.write('{0} {1}\n'.format(stack, count))
+    return write
+
+
+def _read_collapsed(filename):
+    stacks = Counter()
+    with open(filename) as cf:
+        for line in cf:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+class StackSampler(object):
+    """Collects collapsed stacks of the thread that starts it, from a
+    background thread that reads that thread's frame every interval.
+
+    Samples are taken on wall-clock time, so time spent waiting on upstream
+    in fetch shows up as well as time spent running Python. No signals are
+    used, so it works from any thread and under servers that restrict
+    signal handlers, like mod_wsgi. A request shorter than the interval
+    gets at most one sample, so lower TFL_PROFILE_INTERVAL for fast queries.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+        self._ident = None
+        self._thread = None
+
+    def start(self):
+        self._ident = threading.current_thread().ident
+        self._thread = threading.Thread(target=self._run, name='StackSampler')
+        self._thread.daemon = True
+        self.running = True
+        try:
+            self._thread.start()
+        except:
+            self.running = False
+            raise
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._thread.join()
+
+    def _run(self):
+        # Start at a random phase, so requests shorter than the interval
+        # are still sampled in proportion to their duration
+        import random
+        delay = random.uniform(0, self.interval)
+        while self.running:
+            time.sleep(delay)
+            delay = self.interval
+            frame = sys._current_frames().get(self._ident)
+            if self.running and frame is not None:
+                self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0}:{1}'.format(os.path.basename(code.co_filename),
+                                          code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+
+class Sample(object):
+    """A single profiled request, using either cProfile or a StackSampler"""
+
+    def __init__(self, mode, interval):
+        self.profile = None
+        self.sampler = None
+        if mode == MODE_STACKS:
+            self.sampler = StackSampler(interval)
+        else:
+            import cProfile
+            self.profile = cProfile.Profile()
+
+    def start(self):
+        if self.sampler:
+            self.sampler.start()
+        if self.profile:
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile:
+            self.profile.disable()
+        if self.sampler:
+            self.sampler.stop()
+
+
+class Profiler(object):
+    """Profiles a sample of requests, aggregating results by query type.
+
+    Off unless TFL_PROFILE_RATE is above zero, or a request carries an
+    X-TfL-Profile header matching TFL_PROFILE_TOKEN. TFL_PROFILE_MODE picks
+    pstats (the default) or collapsed stacks. Only one request is profiled
+    at a time, so the overhead is bounded by the sample rate.
+
+    Long-lived WSGI workers keep their results until a request carrying
+    X-TfL-Profile-Dump asks for a dump. A CGI process dumps whatever it has
+    as it exits, so under CGI that header adds nothing; run merge() instead
+    to get up to date results.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+        self._dumps = 0
+
+    def _authorised(self, environ, header):
+        token = environ.get(PROFILE_TOKEN, '')
+        value = environ.get(header, '')
+        if not token or not value:
+            return False
+        import hmac
+        return hmac.compare_digest(str(token), str(value))
+
+    def begin(self, environ):
+        """Start profiling the request if it's sampled, returning the Sample
+        to pass to end(), otherwise None"""
+        rate = _getfloat(environ, PROFILE_RATE, 0.0)
+        sampled = self._authorised(environ, PROFILE_HEADER)
+        if rate > 0 and not sampled:
+            import random
+            sampled = random.random() < rate
+        if not sampled or not self._active.acquire(False):
+            return None
+
+        interval = _getfloat(environ, PROFILE_INTERVAL, DEFAULT_INTERVAL)
+        sample = Sample(environ.get(PROFILE_MODE, MODE_PSTATS),
+                        interval if interval > 0 else DEFAULT_INTERVAL)
+        try:
+            sample.start()
+        except Exception:
+            try:
+                sample.stop()
+            finally:
+                self._active.release()
+            logging.exception('Unable to start profiling request')
+            return None
+        return sample
+
+    def end(self, sample, query):
+        """Stop profiling and add the results to those of the query type"""
+        try:
+            sample.stop()
+        finally:
+            self._active.release()
+
+        profile_stats = None
+        if sample.profile:
+            import pstats
+            try:
+                profile_stats = pstats.Stats(sample.profile)
+            except TypeError:
+                # Nothing was recorded
+                pass
+
+        with self._lock:
+            if profile_stats is not None:
+                self._add_stats(query, profile_stats)
+            if sample.sampler and sample.sampler.stacks:
+                self._add_stacks(query, sample.sampler.stacks)
+
+    def _add_stats(self, query, profile_stats):
+        if query in self.stats:
+            self.stats[query].add(profile_stats)
+        else:
+            self.stats[query] = profile_stats
+
+    def _add_stacks(self, query, sampled):
+        stacks = self.stacks.setdefault(query, Counter())
+        for stack, count in sampled.items():
+            if stack not in stacks and len(stacks) >= MAX_STACKS:
+                stack = TRUNCATED_STACK
+            stacks[stack] += count
+
+    def wants_dump(self, environ):
+        """Whether the request asks for a dump with X-TfL-Profile-Dump"""
+        return self._authorised(environ, PROFILE_DUMP_HEADER)
+
+    def dump(self, folder=None):
+        """Write the results for each query type to new files in its own
+        folder, then reset the in-memory results.
+
+        Every dump gets its own files, so processes never write to the same
+        file; merge() combines them afterwards. If writing fails, whatever
+        wasn't written is put back in memory for the next dump.
+        """
+        folder = folder or DEFAULT_DIR
+        with self._lock:
+            stats, self.stats = self.stats, {}
+            stacks, self.stacks = self.stacks, {}
+            self._dumps += 1
+            name = '{0}-{1}-{2}'.format(time.strftime('%Y%m%d%H%M%S'),
+                                        os.getpid(), self._dumps)
+        queries = sorted(set(stats) | set(stacks))
+
+        try:
+            for query in list(stats):
+                filename = os.path.join(folder, query, name + PSTATS_EXTENSION)
+                _write_atomic(filename, stats[query].dump_stats)
+                del stats[query]
+
+            for query in list(stacks):
+                filename = os.path.join(folder, query,
+                                        name + COLLAPSED_EXTENSION)
+                _write_atomic(filename, _write_collapsed(stacks[query]))
+                del stacks[query]
+        except:
+            with self._lock:
+                for query, query_stats in stats.items():
+                    self._add_stats(query, query_stats)
+                for query, query_stacks in stacks.items():
+                    self._add_stacks(query, query_stacks)
+            raise
+
+        logging.info('Dumped profiles for %s to %s', queries, folder)
+
+
+def _set_aside(filename, error):
+    logging.warning('Skipping unreadable profile %s: %s', filename, error)
+    try:
+        os.rename(filename, filename + '.bad')
+    except (IOError, OSError) as e:
+        logging.warning('Unable to set aside %s: %s', filename, e)
+
+
+def _remove(filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to remove merged profile %s: %s',
+                            filename, e)
+
+
+def merge(folder=None):
+    """Fold the dumps in the folder into a <query>.pstats and
+    <query>.collapsed file per query type, returning the query types.
+
+    Merged dumps are removed, so the folder only grows by the dumps taken
+    since the last merge. Files that can't be read, including a merged
+    file, are renamed with a .bad extension and skipped. Run one merge at
+    a time, eg. from cron.
+    """
+    import pstats
+    folder = folder or DEFAULT_DIR
+    queries = []
+
+    try:
+        names = sorted(os.listdir(folder))
+    except (IOError, OSError) as e:
+        return queries
+
+    for query in names:
+        query_folder = os.path.join(folder, query)
+        if not os.path.isdir(query_folder):
+            continue
+        try:
+            dumps = [os.path.join(query_folder, filename)
+                     for filename in sorted(os.listdir(query_folder))]
+        except (IOError, OSError) as e:
+            logging.warning('Unable to list profiles in %s: %s',
+                            query_folder, e)
+            continue
+        merged = False
+
+        pstats_dumps = [f for f in dumps if f.endswith(PSTATS_EXTENSION)]
+        if pstats_dumps:
+            target = os.path.join(folder, query + PSTATS_EXTENSION)
+            existing = [target] if os.path.exists(target) else []
+            stats = None
+            consumed = []
+            for filename in existing + pstats_dumps:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(filename)
+                    else:
+                        stats.add(filename)
+                except Exception as e:
+                    _set_aside(filename, e)
+                    continue
+                consumed.append(filename)
+            if stats is not None:
+                _write_atomic(target, stats.dump_stats)
+                _remove(f for f in consumed if f != target)
+                merged = True
+
+        collapsed_dumps = [f for f in dumps if f.endswith(COLLAPSED_EXTENSION)]
+        if collapsed_dumps:
+            target = os.path.join(folder, query + COLLAPSED_EXTENSION)
+            existing = [target] if os.path.exists(target) else []
+            stacks = Counter()
+            consumed = []
+            for filename in existing + collapsed_dumps:
+                try:
+                    stacks.update(_read_collapsed(filename))
+                except Exception as e:
+                    _set_aside(filename, e)
+                    continue
+                consumed.append(filename)
+            if consumed:
+                _write_atomic(target, _write_collapsed(stacks))
+                _remove(f for f in consumed if f != target)
+                merged = True
+
+        if merged:
+            queries.append(query)
+
+    return queries
+
+
+if __name__ == '__main__':
+    merged = merge(sys.argv[1] if len(sys.argv) > 1 else None)
+    print('Merged profiles for {}'.format(', '.join(merged) or 'nothing'))
@@ -4,17 +4,13 @@ from __future__ import print_function
 
 from abc import ABCMeta, abstractmethod
 import errno
-import json
 import logging
 import os
 import status
 import time
-import urllib2
 
-try:
-    import xml.etree.cElementTree as etree
-except ImportError:
-    import xml.etree.ElementTree as etree
+# json, urllib2 and etree are only needed when a query misses the cache and
+# goes upstream, so they're imported where used to keep process startup cheap
 
 
 # Query arguments
@@ -49,6 +45,11 @@ BASE_URL = "http://cloud.tfl.gov.uk/trackernet"
 BASE_FILE = "cache"
 FILE_EXTENSION = ".json"
 
+# In-process cache of {cache_filename: (mtime, expiry, json)}, in front of
+# the files, which stay authoritative; checked against their mtime on each hit
+_memory_cache = {}
+MEMORY_CACHE_SIZE = 1024
+
 
 def stob(s_val):
     s_val = s_val.lower()
@@ -56,6 +57,27 @@ def stob(s_val):
     return b_val
 
 
+def _remember(cache_filename, mtime, expiry, cached):
+    if len(_memory_cache) >= MEMORY_CACHE_SIZE:
+        # Drop expired entries in bulk, and if it's still full of valid ones
+        # leave this one to be read from its file
+        ctime = time.time()
+        for key, entry in _memory_cache.items():
+            if entry[0] < ctime - entry[1]:
+                _memory_cache.pop(key, None)
+        if len(_memory_cache) >= MEMORY_CACHE_SIZE:
+            return
+    _memory_cache[cache_filename] = (mtime, expiry, cached)
+
+
+def _import_etree():
+    try:
+        import xml.etree.cElementTree as etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+    return etree
+
+
 class BaseQuery(object):
     __metaclass__ = ABCMeta
 
@@ -69,10 +91,11 @@ class BaseQuery(object):
         self.form = form
         self.request_url = self._process_request()
         self.cache_filename = self._make_filename()
-        # Get strings for the namespace-qualified tags
+        # Get strings for the namespace-qualified tags, on a per-instance
+        # copy so the class's tags aren't qualified again by later instances
         if self.xmlns:
-            for key, val in self.tags.items():
-                self.tags[key] = etree.QName(self.xmlns, val).text
+            self.tags = dict((key, '{{{0}}}{1}'.format(self.xmlns, val))
+                             for key, val in self.tags.items())
 
     @abstractmethod
     def _process_request(self):
@@ -87,11 +110,13 @@ class BaseQuery(object):
         return NotImplemented
 
     def _request(self):
+        import urllib2
         req = urllib2.Request(self.request_url)
         res = urllib2.urlopen(req, timeout=10)
         return res
 
     def _get_xml(self, res):
+        etree = _import_etree()
         try:
             xml = etree.parse(res)
             root = xml.getroot()
@@ -103,16 +128,25 @@ class BaseQuery(object):
 
     def _get_cache(self):
         cached = ''
+        ctime = time.time() - self.cache_expiry_time
 
         try:
             mtime = os.path.getmtime(self.cache_filename)
-            ctime = time.time() - self.cache_expiry_time
 
             if mtime >= ctime:
+                # Single lookup, as other threads may replace or drop it
+                entry = _memory_cache.get(self.cache_filename)
+                if entry and entry[0] == mtime:
+                    return entry[2]
                 with open(self.cache_filename) as cf:
                     cached = cf.read()
+                _remember(self.cache_filename, mtime, self.cache_expiry_time,
+                          cached)
+            else:
+                _memory_cache.pop(self.cache_filename, None)
         except (IOError, OSError) as e:
             if e.errno == errno.ENOENT:
+                _memory_cache.pop(self.cache_filename, None)
                 return None
             raise e
 
@@ -133,6 +167,9 @@ class BaseQuery(object):
             try:
                 with open(self.cache_filename, 'w') as cf:
                     cf.write(json)
+                _remember(self.cache_filename,
+                          os.path.getmtime(self.cache_filename),
+                          self.cache_expiry_time, json)
                 retry = False
             except (IOError, OSError) as e:
                 if e.errno == errno.ENOENT:
@@ -148,6 +185,8 @@ class BaseQuery(object):
         resp_json = self._get_cache()
 
         if not resp_json:
+            import json
+            import urllib2
             res = None
             try:
                 res = self._request()
@@ -400,6 +439,7 @@ class StationListQuery(BaseQuery):
         return resp
 
     def fetch_line(self, code, name, spq):
+        import urllib2
         resp = {
             'linecode': code,
             'linename': name,
@@ -427,6 +467,7 @@ class StationListQuery(BaseQuery):
         resp_json = self._get_cache()
 
         if not resp_json:
+            import json
             lines = []
             for code, item in self.lines.items():
                 name, spq = item
@@ -438,3 +479,49 @@ class StationListQuery(BaseQuery):
 
         return resp_json
 
+
+# Cache expiry times by query, for entries read without a query instance
+CACHE_EXPIRY_TIMES = dict((cls.query, cls.cache_expiry_time) for cls in (
+    DetailedPredictionQuery, SummaryPredictionQuery, LineStatusQuery,
+    StationStatusQuery, StationListQuery))
+
+
+def preload_cache():
+    """Load every still-valid file cache entry into the in-process cache.
+
+    Meant to be called once as a worker starts, so its first requests don't
+    all go upstream. Returns the number of entries loaded.
+    """
+    base_folder = os.path.join('.', BASE_FILE)
+    now = time.time()
+    loaded = 0
+
+    for folder, _, filenames in os.walk(base_folder):
+        for filename in filenames:
+            if not filename.endswith(FILE_EXTENSION):
+                continue
+            cache_filename = os.path.join(folder, filename)
+            # First path component under the cache folder is the query
+            relative = os.path.relpath(cache_filename, base_folder)
+            query = relative.split(os.sep)[0]
+            if query.endswith(FILE_EXTENSION):
+                query = query[:-len(FILE_EXTENSION)]
+            if query not in CACHE_EXPIRY_TIMES:
+                continue
+
+            try:
+                mtime = os.path.getmtime(cache_filename)
+                if mtime < now - CACHE_EXPIRY_TIMES[query]:
+                    continue
+                with open(cache_filename) as cf:
+                    cached = cf.read()
+            except (IOError, OSError) as e:
+                logging.debug('Unable to preload %s: %s', cache_filename, e)
+                continue
+
+            if cached:
+                _remember(cache_filename, mtime, CACHE_EXPIRY_TIMES[query],
+                          cached)
+                loaded += 1
+
+    return loaded
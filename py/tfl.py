@@ -3,12 +3,17 @@
 from __future__ import print_function
 
 from datetime import datetime
+# Taken before the remaining imports so startup time includes them
+STARTUP_TIME = datetime.now()
+
 from status import StatusCodes, RequestError, ResponseError
 from wsgiref.handlers import CGIHandler
+import profiler
 import query
 import types
 import urlparse
 import logging
+import os
 
 # Queries for parse_args
 QUERIES = {
@@ -21,6 +26,38 @@ QUERIES = {
 
 SEQUENCES_TYPE = (set, dict, list, tuple)
 
+# Whether this process has served a request yet, for first-request latency
+_first_request = True
+# Whether warm_start has run in this WSGI worker, see application
+_warm_started = False
+
+# Samples requests for profiling, see profiler.Profiler
+PROFILER = profiler.Profiler()
+
+def configure_logging():
+    logging.basicConfig(filename='tfl.py.log', level=logging.DEBUG,
+        format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+def warm_start(preload=True):
+    """Preload the file cache into memory before serving any requests.
+
+    Run once per long-lived WSGI worker by application, so its first hits
+    are answered from memory rather than a read of each cache file. A CGI
+    process serves a single request, so walking the whole cache would only
+    slow it down; it passes preload=False and just logs the startup timing.
+    """
+    configure_logging()
+
+    loaded = 0
+    preload_start = datetime.now()
+    if preload:
+        loaded = query.preload_cache()
+    preload_end = datetime.now()
+
+    logging.info('Warm start: Imports: %s; Preloaded %d cache entries: %s; '
+                 'Startup time: %s', preload_start - STARTUP_TIME, loaded,
+                 preload_end - preload_start, preload_end - STARTUP_TIME)
+
 def parse_query(environ):
     form = {}
     query_class = None
@@ -72,20 +109,23 @@ def parse_query(environ):
     return (query_instance, form)
 
 def main(environ, start_response):
-    logging.basicConfig(filename='tfl.py.log', level=logging.DEBUG,
-        format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    global _first_request
+    configure_logging()
 
     status_code = StatusCodes.gethttpstatus(StatusCodes.HTTP_INTERNAL_SERVER_ERROR)
     response_headers = [("Content-Type", "application/json; charset=UTF-8")]
     response_body = []
     form = None
+    query_type = 'invalid'
 
     start_time = datetime.now()
 
     logging.info('Environ: %s', environ)
 
+    sample = PROFILER.begin(environ)
     try:
         req, form = parse_query(environ)
+        query_type = req.query
         response_body = req.fetch()
         status_code = StatusCodes.gethttpstatus(StatusCodes.HTTP_OK)
     except (RequestError, ResponseError) as re:
@@ -95,9 +135,22 @@ def main(environ, start_response):
         response_body = re.message if re.status.canhavebody else ''
     except Exception as e:
         logging.exception('Unknown exception processing request')
+    finally:
+        # Always end the sample, or profiling stays on for this worker
+        if sample:
+            try:
+                PROFILER.end(sample, query_type)
+            except Exception as e:
+                logging.exception('Unable to end profiling request')
 
     end_time = datetime.now()
 
+    if PROFILER.wants_dump(environ):
+        try:
+            PROFILER.dump(environ.get(profiler.PROFILE_DIR))
+        except Exception as e:
+            logging.exception('Unable to dump profiles')
+
     try:
         # Make sure we're passing a sensible sequence
         if not isinstance(response_body, SEQUENCES_TYPE):
@@ -113,6 +166,10 @@ def main(environ, start_response):
 
         logging.info('Request: %s; Response: %s; Start time: %s; End time: %s',
                      form, status_code, start_time, end_time)
+        if _first_request:
+            _first_request = False
+            logging.info('First request latency: %s; Since startup: %s',
+                         end_time - start_time, end_time - STARTUP_TIME)
     except Exception as e:
         logging.exception('Unknown exception sending response')
         status_code = StatusCodes.gethttpstatus(StatusCodes.HTTP_INTERNAL_SERVER_ERROR)
@@ -123,5 +180,24 @@ def main(environ, start_response):
     start_response(status_code, response_headers)
     return response_body
 
+def application(environ, start_response):
+    """WSGI entry point, eg. for mod_wsgi's WSGIScriptAlias.
+
+    Warm starts the worker on its first request, then serves through main.
+    Two threads racing on the first request at worst both preload.
+    """
+    global _warm_started
+    if not _warm_started:
+        _warm_started = True
+        warm_start()
+    return main(environ, start_response)
+
 if __name__ == '__main__':
+    warm_start(preload=False)
     CGIHandler().run(main)
+    # Each CGI process serves one request, so keep any profile it took
+    if PROFILER.stats or PROFILER.stacks:
+        try:
+            PROFILER.dump(os.environ.get(profiler.PROFILE_DIR))
+        except Exception as e:
+            logging.exception('Unable to dump profiles')